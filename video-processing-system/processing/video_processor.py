@@ -3,9 +3,12 @@
 import cv2
 import numpy as np
 import asyncio
+import fcntl
+import itertools
 import json
 import logging
 import os
+import re
 import sys
 import time
 from concurrent.futures import ThreadPoolExecutor
@@ -13,14 +16,31 @@ from threading import Lock
 import subprocess
 import signal
 
+try:
+    CUDA_EFFECTS_AVAILABLE = cv2.cuda.getCudaEnabledDeviceCount() > 0
+except (AttributeError, cv2.error):
+    CUDA_EFFECTS_AVAILABLE = False
+
 try:
     import torch
     import torchvision.transforms as transforms
+    from torch.ao.quantization import (QConfig, QConfigMapping, FixedQParamsObserver,
+                                       default_per_channel_weight_observer, get_default_qconfig)
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
     GPU_AVAILABLE = torch.cuda.is_available()
 except ImportError:
     print("PyTorch not available, using CPU-only processing")
     GPU_AVAILABLE = False
 
+try:
+    import tensorrt as trt
+    TRT_LOGGER = trt.Logger(trt.Logger.WARNING)
+    TENSORRT_AVAILABLE = True
+except ImportError:
+    print("TensorRT not available, using PyTorch for ML enhancement")
+    TENSORRT_AVAILABLE = False
+
 try:
     import gi
     gi.require_version('Gst', '1.0')
@@ -31,32 +51,294 @@ except ImportError:
     print("GStreamer not available, using OpenCV/FFmpeg fallback")
     GSTREAMER_AVAILABLE = False
 
+try:
+    import numba
+    NUMBA_AVAILABLE = True
+except ImportError:
+    print("Numba not available, using OpenCV for color filtering")
+    NUMBA_AVAILABLE = False
+
+# F_SETPIPE_SZ is only exported by the fcntl module on Python 3.10+
+PIPE_SIZE_FLAG = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+PIPE_SIZE = 1 << 20
+
+# cv::CPU_AVX2 feature id; the Python bindings do not export the CPU_* constants
+CV_CPU_AVX2 = 11
+
+# Weight of the newest sample in the per-stream latency moving averages
+STATS_SMOOTHING = 0.1
+# Below this size stackBlur is slower than the separable Gaussian it approximates
+STACK_BLUR_MIN_KERNEL = 31
+
+# Streams per page of stat arrays; pages are never resized or moved
+STREAM_STATS_PAGE_SIZE = 64
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+if NUMBA_AVAILABLE:
+    # BGR -> HSV -> rotated hue -> BGR in one pass per pixel. The shift is in
+    # OpenCV 8-bit hue units (2 degrees), matching the color_filter config.
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def hue_shift_bgr(src, dst, shift):
+        height, width = src.shape[0], src.shape[1]
+        rotation = shift / 30.0
+
+        for y in numba.prange(height):
+            for x in range(width):
+                b = float(src[y, x, 0])
+                g = float(src[y, x, 1])
+                r = float(src[y, x, 2])
+
+                value = max(r, g, b)
+                low = min(r, g, b)
+                chroma = value - low
+                if chroma == 0.0:
+                    dst[y, x, 0] = src[y, x, 0]
+                    dst[y, x, 1] = src[y, x, 1]
+                    dst[y, x, 2] = src[y, x, 2]
+                    continue
+
+                if value == r:
+                    hue = (g - b) / chroma
+                elif value == g:
+                    hue = 2.0 + (b - r) / chroma
+                else:
+                    hue = 4.0 + (r - g) / chroma
+
+                hue = (hue + rotation) % 6.0
+                sector = int(hue)
+                # A tiny negative sum wraps to exactly 6.0 under float modulo
+                if sector >= 6:
+                    sector = 0
+                    hue -= 6.0
+                rising = low + chroma * (hue - sector)
+                falling = value - chroma * (hue - sector)
+
+                if sector == 0:
+                    r, g, b = value, rising, low
+                elif sector == 1:
+                    r, g, b = falling, value, low
+                elif sector == 2:
+                    r, g, b = low, value, rising
+                elif sector == 3:
+                    r, g, b = low, falling, value
+                elif sector == 4:
+                    r, g, b = rising, low, value
+                else:
+                    r, g, b = value, low, falling
+
+                dst[y, x, 0] = np.uint8(b + 0.5)
+                dst[y, x, 1] = np.uint8(g + 0.5)
+                dst[y, x, 2] = np.uint8(r + 0.5)
+
+    # Approximate luma as (B + 2G + R) >> 2: shifts and adds instead of the
+    # weighted BT.601 sum, close enough for Canny input.
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def fast_luma_bgr(src, dst):
+        height, width = src.shape[0], src.shape[1]
+        rows = src.reshape(height, width * 3)
+
+        for y in numba.prange(height):
+            row = rows[y]
+            out = dst[y]
+            for x in range(width):
+                i = 3 * x
+                out[x] = (row[i] + 2 * np.int32(row[i + 1]) + row[i + 2]) >> 2
+
+# Per-stream counters for a fixed number of streams, as parallel arrays
+class StreamStatsPage:
+    def __init__(self, size):
+        self.start_times = np.zeros(size, dtype=np.float64)
+        self.frame_counts = np.zeros(size, dtype=np.int64)
+        self.dropped_frames = np.zeros(size, dtype=np.int64)
+        self.e2e_latency = np.zeros(size, dtype=np.float64)
+        self.f2f_interval = np.zeros(size, dtype=np.float64)
+        self.last_output_times = np.zeros(size, dtype=np.float64)
+
+    def reset(self, index):
+        self.start_times[index] = time.time()
+        self.frame_counts[index] = 0
+        self.dropped_frames[index] = 0
+        self.e2e_latency[index] = 0.0
+        self.f2f_interval[index] = 0.0
+        self.last_output_times[index] = np.nan
+
+# ndarray view straight over a mapped GstBuffer. The mapping is held by every
+# view derived from the frame and is only released once the last one is gone.
+class GstMappedFrame(np.ndarray):
+    class _Mapping:
+        def __init__(self, buffer, map_info):
+            self.buffer = buffer
+            self.map_info = map_info
+
+        def __del__(self):
+            self.buffer.unmap(self.map_info)
+
+    def __array_finalize__(self, obj):
+        self._mapping = getattr(obj, '_mapping', None)
+
+    @classmethod
+    def from_buffer(cls, buffer, width, height):
+        success, map_info = buffer.map(Gst.MapFlags.READ)
+        if not success:
+            return None
+
+        try:
+            frame = np.frombuffer(map_info.data, dtype=np.uint8).reshape((height, width, 3)).view(cls)
+        except Exception:
+            buffer.unmap(map_info)
+            raise
+
+        frame._mapping = cls._Mapping(buffer, map_info)
+        return frame
+
+if TENSORRT_AVAILABLE:
+    # Feeds one real batch of frames to TensorRT's INT8 calibration
+    class EnhancerCalibrator(trt.IInt8EntropyCalibrator2):
+        def __init__(self, batch):
+            super().__init__()
+            self.batch = batch.float().contiguous()
+            self.pending = True
+
+        def get_batch_size(self):
+            return self.batch.shape[0]
+
+        def get_batch(self, names):
+            if not self.pending:
+                return None
+            self.pending = False
+            return [self.batch.data_ptr()]
+
+        def read_calibration_cache(self):
+            return None
+
+        def write_calibration_cache(self, cache):
+            pass
+
+# Serialized TensorRT engine for the enhancement model, fed with device tensors
+class TensorRTEnhancer:
+    def __init__(self, engine_bytes):
+        self.runtime = trt.Runtime(TRT_LOGGER)
+        self.engine = self.runtime.deserialize_cuda_engine(engine_bytes)
+        self.context = self.engine.create_execution_context()
+
+    @staticmethod
+    def build(onnx_path, height, width, max_batch, calibration_batch=None):
+        builder = trt.Builder(TRT_LOGGER)
+        network = builder.create_network(1 << int(trt.NetworkDefinitionCreationFlag.EXPLICIT_BATCH))
+        parser = trt.OnnxParser(network, TRT_LOGGER)
+
+        with open(onnx_path, 'rb') as f:
+            if not parser.parse(f.read()):
+                raise RuntimeError(f"Failed to parse {onnx_path}: {parser.get_error(0)}")
+
+        config = builder.create_builder_config()
+        config.set_flag(trt.BuilderFlag.FP16)
+
+        profile = builder.create_optimization_profile()
+        profile.set_shape('x', (1, 3, height, width), (max_batch, 3, height, width), (max_batch, 3, height, width))
+        config.add_optimization_profile(profile)
+
+        if calibration_batch is not None:
+            config.set_flag(trt.BuilderFlag.INT8)
+            config.int8_calibrator = EnhancerCalibrator(calibration_batch)
+            # Calibration binds the profile's opt shape, so it gets a profile fixed
+            # to the batch it actually holds rather than the full batch size
+            calibration_shape = tuple(calibration_batch.shape)
+            calibration_profile = builder.create_optimization_profile()
+            calibration_profile.set_shape('x', calibration_shape, calibration_shape, calibration_shape)
+            config.set_calibration_profile(calibration_profile)
+
+        serialized = builder.build_serialized_network(network, config)
+        if serialized is None:
+            raise RuntimeError("TensorRT engine build failed")
+        return bytes(serialized)
+
+    def __call__(self, batch):
+        batch = batch.float().contiguous()
+        output = torch.empty_like(batch)
+
+        self.context.set_input_shape('x', tuple(batch.shape))
+        self.context.set_tensor_address('x', batch.data_ptr())
+        self.context.set_tensor_address('y', output.data_ptr())
+        self.context.execute_async_v3(torch.cuda.current_stream().cuda_stream)
+        return output
+
 class VideoProcessor:
     def __init__(self, config_file='config.json'):
         self.config = self.load_config(config_file)
         self.active_streams = {}
         self.processing_queue = asyncio.Queue()
-        self.executor = ThreadPoolExecutor(max_workers=self.config.get('max_workers', 4))
         self.lock = Lock()
 
+        ml_config = self.config['processing_effects']['ml_enhancement']
+
+        # Bounded capture -> effects -> (ML) -> encode pipeline; each stage owns a thread.
+        # Frames waiting on the ML batch sit in the encode queue, so it also has
+        # room for a full batch or batches would never fill.
+        self.queue_size = self.config.get('queue_size', 4)
+        encode_queue_size = self.queue_size
+        if ml_config['enabled']:
+            encode_queue_size += ml_config.get('batch_size', 16)
+        self._effects_queue = asyncio.Queue(maxsize=self.queue_size)
+        self._encode_queue = asyncio.Queue(maxsize=encode_queue_size)
+        self._effects_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='effects')
+        self._ml_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ml')
+        # TensorRT builds and torch.compile warm-ups run here, off the ML thread
+        self._ml_build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ml-build')
+        self._encode_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='encode')
+        self._pipeline_tasks = []
+        self.loop = None
+
+        # Newest captured frame per live stream; older ones are overwritten, not queued
+        self._latest = {}
+        self._frame_ready = asyncio.Event()
+
+        self.ml_batch_size = ml_config.get('batch_size', 16)
+        self.ml_batch_timeout = ml_config.get('batch_timeout', 0.005)
+        self.ml_queue = asyncio.Queue()
+        self._ml_worker_task = None
+        self._ml_stage = {}
+        self._trt_onnx_path = None
+        self.ml_precision = ml_config.get('precision', 'fp16')
+        self._ml_quantized = False
+        self._ml_compiled = None
+        self._ml_backends = {}
+        self._ml_backends_pending = set()
+        self._scratch = {}
+        self._gpu_scratch = {}
+        self._nvenc_available = None
+        self._encoders = {}
+        self._encoder_cmds = {}
+        self._encoder_shapes = {}
+
+        # Per-stream counters live in pages of parallel arrays, addressed by a
+        # (page, index) slot. A slot never moves and a removed stream's slot is
+        # left as a tombstone rather than reused, so the lock-free writers can
+        # never land in another stream's counters.
+        self._stream_slots = {}
+        self._stats_pages = []
+        self._stats_slots_used = 0
+        self.ml_half = False
+
         self.setup_gpu()
-        self.setup_models()
+        self.setup_opencv()
+        self.setup_effects()
 
         logger.info(f"VideoProcessor initialized - GPU: {GPU_AVAILABLE}, GStreamer: {GSTREAMER_AVAILABLE}")
 
     def load_config(self, config_file):
         default_config = {
             "gpu_enabled": True,
-            "max_workers": 4,
+            "queue_size": 4,
             "output_formats": ["webrtc", "hls", "dash"],
             "processing_effects": {
                 "blur": {"enabled": False, "kernel_size": 15},
-                "edge_detection": {"enabled": False, "threshold1": 100, "threshold2": 200},
+                "edge_detection": {"enabled": False, "threshold1": 100, "threshold2": 200, "fast_luma": False},
                 "color_filter": {"enabled": False, "hue_shift": 0},
-                "ml_enhancement": {"enabled": False, "model": "esrgan"}
+                "ml_enhancement": {"enabled": False, "model": "esrgan", "batch_size": 16, "batch_timeout": 0.005,
+                                   "precision": "fp16"}
             },
             "streaming": {
                 "webrtc_bitrate": 2000000,
@@ -80,15 +362,100 @@ class VideoProcessor:
             self.device = torch.device('cpu')
             logger.info("Using CPU processing")
 
-    def setup_models(self):
+    def setup_opencv(self):
+        cv2.setUseOptimized(True)
+        cv2.setNumThreads(os.cpu_count() or 1)
+
+        build_info = cv2.getBuildInformation()
+        simd = set()
+        for label in ('Baseline', 'Dispatched code generation'):
+            match = re.search(rf'^\s*{label}:\s*(.*)$', build_info, re.MULTILINE)
+            if match:
+                simd.update(match.group(1).split())
+
+        match = re.search(r'^\s*Intel IPP:\s*(.*)$', build_info, re.MULTILINE)
+        ipp_enabled = match is not None and not match.group(1).startswith('NO')
+
+        logger.info(f"OpenCV {cv2.__version__} - IPP: {ipp_enabled}, SIMD: {' '.join(sorted(simd)) or 'none'}")
+
+        # The PyPI wheels all share one dispatch/IPP configuration, so the remedy
+        # for either gap is an OpenCV source build with these flags
+        build_flags = "-DCPU_BASELINE=AVX2 -DCPU_DISPATCH=AVX512_SKX -DWITH_IPP=ON"
+        if cv2.checkHardwareSupport(CV_CPU_AVX2) and 'AVX2' not in simd:
+            logger.warning("OpenCV was built without AVX2 dispatch on an AVX2 CPU; "
+                           f"rebuild it with {build_flags} for the SIMD code paths")
+        if cv2.checkHardwareSupport(CV_CPU_AVX2) and not ipp_enabled:
+            logger.warning("OpenCV was built without Intel IPP; filters and color conversion run slower. "
+                           f"Rebuild it with {build_flags}")
+
+    def setup_effects(self):
         self.models = {}
+        self._gauss_kernel = None
 
-        if GPU_AVAILABLE and self.config['processing_effects']['ml_enhancement']['enabled']:
+        # INT8 makes the model cheap enough to run on the CPU as well
+        if (GPU_AVAILABLE or self.ml_precision == 'int8') and self.config['processing_effects']['ml_enhancement']['enabled']:
             try:
                 self.models['enhancement'] = self.load_enhancement_model()
             except Exception as e:
                 logger.warning(f"Failed to load ML enhancement model: {e}")
 
+        blur_config = self.config['processing_effects']['blur']
+        if blur_config['enabled']:
+            self._gauss_kernel = cv2.getGaussianKernel(blur_config['kernel_size'], 0)
+
+        # Hue rotation as a lookup table on the H channel, identity on S and V
+        hue_shift = self.config['processing_effects']['color_filter']['hue_shift']
+        identity = np.arange(256, dtype=np.uint8)
+        hue_lut = ((np.arange(256) + hue_shift) % 180).astype(np.uint8)
+        self._hue_lut = np.stack([hue_lut, identity, identity], axis=-1).reshape(1, 256, 3)
+
+        # With no other CPU effect in front of it, the color filter runs as a single fused pass
+        effects_config = self.config['processing_effects']
+        self._fused_hue_shift = (NUMBA_AVAILABLE
+                                 and effects_config['color_filter']['enabled']
+                                 and not effects_config['blur']['enabled']
+                                 and not effects_config['edge_detection']['enabled'])
+
+        self._fast_luma = effects_config['edge_detection'].get('fast_luma', False)
+        if self._fast_luma and not NUMBA_AVAILABLE:
+            logger.warning("fast_luma requires Numba; using cv2.cvtColor for edge detection")
+            self._fast_luma = False
+
+        # Edge output goes to the encoders as single-channel gray when nothing runs after it
+        self._edge_terminal = (effects_config['edge_detection']['enabled']
+                               and not effects_config['color_filter']['enabled']
+                               and not (effects_config['ml_enhancement']['enabled'] and 'enhancement' in self.models))
+
+        # With no effect enabled the frame passes through untouched, so never upload it.
+        # cv::cuda separable filters take at most 32 taps, so larger blurs stay on
+        # the CPU, where stackBlur handles them.
+        any_effect = any(effects_config[name]['enabled']
+                         for name in ('blur', 'edge_detection', 'color_filter'))
+        gpu_blur_supported = not blur_config['enabled'] or blur_config['kernel_size'] <= 32
+        self._gpu_effects = (CUDA_EFFECTS_AVAILABLE and self.config.get('gpu_enabled', True)
+                             and any_effect and gpu_blur_supported)
+        if self._gpu_effects:
+            try:
+                self.setup_gpu_effects()
+            except cv2.error as e:
+                logger.warning(f"OpenCV CUDA effects unavailable, running effects on the CPU: {e}")
+                self._gpu_effects = False
+
+    def setup_gpu_effects(self):
+        effects_config = self.config['processing_effects']
+
+        if effects_config['blur']['enabled']:
+            kernel_size = effects_config['blur']['kernel_size']
+            self._gpu_blur = cv2.cuda.createGaussianFilter(cv2.CV_8UC3, cv2.CV_8UC3,
+                                                           (kernel_size, kernel_size), 0)
+        if effects_config['edge_detection']['enabled']:
+            self._gpu_canny = cv2.cuda.createCannyEdgeDetector(effects_config['edge_detection']['threshold1'],
+                                                               effects_config['edge_detection']['threshold2'])
+        if effects_config['color_filter']['enabled']:
+            self._gpu_hue_lut = cv2.cuda.createLookUpTable(self._hue_lut)
+
+        logger.info("Effects running on GPU via OpenCV CUDA")
+
     def load_enhancement_model(self):
         class SimpleEnhancer(torch.nn.Module):
             def __init__(self):
@@ -104,12 +471,149 @@ class VideoProcessor:
                 x = self.conv3(x)
                 return x
 
-        model = SimpleEnhancer().to(self.device)
+        model = SimpleEnhancer().to(self.device).eval()
+
+        if self.device.type == 'cpu' and self.ml_precision == 'int8':
+            return self.quantize_enhancement_model(model)
+
+        if self.device.type == 'cuda':
+            self._h2d_stream = torch.cuda.Stream()
+
+            if TENSORRT_AVAILABLE:
+                try:
+                    self._trt_onnx_path = self.export_enhancement_onnx(model)
+                except Exception as e:
+                    logger.warning(f"ONNX export failed, falling back to torch.compile: {e}")
+
+        model = model.to(memory_format=torch.channels_last)
+
+        self.ml_half = self.device.type == 'cuda' and torch.cuda.get_device_capability()[0] >= 7
+        if self.ml_half:
+            model = model.half()
+            logger.info("ML enhancement running in FP16 channels_last")
+
+        # Compiled lazily per resolution by _build_enhancer; the eager model serves meanwhile
+        if self._trt_onnx_path is None and self.device.type == 'cuda' and hasattr(torch, 'compile'):
+            self._ml_compiled = torch.compile(model, mode='max-autotune', fullgraph=True)
+
         return model
 
+    def quantize_enhancement_model(self, model):
+        # Per-channel INT8 weights (VNNI on x86). The input arrives as raw uint8 pixels
+        # reinterpreted with scale 1/255, and the output is pinned to the same scale,
+        # so no float normalisation happens on either side of the model.
+        pixel_observer = FixedQParamsObserver.with_args(scale=1 / 255.0, zero_point=0, dtype=torch.quint8,
+                                                        quant_min=0, quant_max=255)
+        qconfig_mapping = (QConfigMapping()
+                           .set_global(get_default_qconfig('x86'))
+                           .set_module_name('conv3', QConfig(activation=pixel_observer,
+                                                             weight=default_per_channel_weight_observer)))
+        prepare_config = (PrepareCustomConfig()
+                          .set_input_quantized_indexes([0])
+                          .set_output_quantized_indexes([0]))
+
+        example = torch.rand((2, 3, 64, 64))
+        prepared = prepare_fx(model, qconfig_mapping, (example,), prepare_custom_config=prepare_config)
+        with torch.inference_mode():
+            for _ in range(4):
+                prepared(torch.rand((2, 3, 64, 64)))
+
+        self._ml_quantized = True
+        logger.info("ML enhancement running as INT8 on CPU")
+        return convert_fx(prepared)
+
+    def export_enhancement_onnx(self, model):
+        temp_path = self.config.get('paths', {}).get('temp', './temp')
+        os.makedirs(temp_path, exist_ok=True)
+        onnx_path = os.path.join(temp_path, 'enhancer.onnx')
+
+        dummy = torch.zeros((1, 3, 64, 64), device=self.device)
+        dynamic_axes = {'x': {0: 'B', 2: 'H', 3: 'W'}, 'y': {0: 'B', 2: 'H', 3: 'W'}}
+        torch.onnx.export(model, dummy, onnx_path, opset_version=17,
+                          input_names=['x'], output_names=['y'], dynamic_axes=dynamic_axes)
+        return onnx_path
+
+    def _enhancer_for(self, batch):
+        height, width = batch.shape[2:]
+        enhancer = self._ml_backends.get((height, width))
+        if enhancer is not None:
+            return enhancer
+
+        if (height, width) not in self._ml_backends_pending:
+            # INT8 engines are calibrated on the first real batch seen at this resolution
+            calibration_batch = None
+            if self._trt_onnx_path is not None and self.ml_precision == 'int8':
+                calibration_batch = batch.clone()
+            self.prepare_enhancer(height, width, calibration_batch)
+        return self.models['enhancement']
+
+    def prepare_enhancer(self, height, width, calibration_batch=None):
+        if self._trt_onnx_path is None and self._ml_compiled is None:
+            return
+
+        # Builds take seconds to minutes, so they never run on the ML thread
+        with self.lock:
+            if (height, width) in self._ml_backends or (height, width) in self._ml_backends_pending:
+                return
+            self._ml_backends_pending.add((height, width))
+
+        self._ml_build_executor.submit(self._build_enhancer, height, width, calibration_batch)
+
+    def _build_enhancer(self, height, width, calibration_batch):
+        try:
+            if self._trt_onnx_path is not None:
+                enhancer = self._build_trt_engine(height, width, calibration_batch)
+            else:
+                enhancer = self._warm_compiled_model(height, width)
+            logger.info(f"Accelerated ML enhancement ready for {width}x{height}")
+        except Exception as e:
+            logger.warning(f"Accelerated ML unavailable for {width}x{height}, using PyTorch: {e}")
+            enhancer = self.models['enhancement']
+
+        with self.lock:
+            self._ml_backends[(height, width)] = enhancer
+            self._ml_backends_pending.discard((height, width))
+
+    def _build_trt_engine(self, height, width, calibration_batch):
+        # Engines are specialised per resolution and cached on disk across restarts
+        gpu_name = torch.cuda.get_device_name().replace(' ', '_')
+        engine_path = os.path.join(os.path.dirname(self._trt_onnx_path),
+                                   f"enhancer_{gpu_name}_{width}x{height}_b{self.ml_batch_size}_{self.ml_precision}.engine")
+        if os.path.exists(engine_path):
+            with open(engine_path, 'rb') as f:
+                engine_bytes = f.read()
+        else:
+            logger.info(f"Building TensorRT engine for {width}x{height}")
+            if calibration_batch is not None:
+                # The clone was queued on the ML thread's stream
+                torch.cuda.synchronize()
+            engine_bytes = TensorRTEnhancer.build(self._trt_onnx_path, height, width,
+                                                  self.ml_batch_size, calibration_batch)
+            with open(engine_path, 'wb') as f:
+                f.write(engine_bytes)
+
+        return TensorRTEnhancer(engine_bytes)
+
+    def _warm_compiled_model(self, height, width):
+        logger.info(f"Compiling ML enhancement for {width}x{height}")
+        # The batch dimension is dynamic, but dynamo still specialises size 1 and
+        # conv can guard on ranges of it, so every size a batch can take is run
+        # once here; sizes an existing graph already covers just run forward.
+        with torch.inference_mode(), torch.cuda.amp.autocast(enabled=self.ml_half, dtype=torch.float16):
+            for batch_size in range(self.ml_batch_size, 0, -1):
+                example = torch.zeros((batch_size, 3, height, width), device=self.device)
+                example = example.to(memory_format=torch.channels_last)
+                if batch_size > 1:
+                    torch._dynamo.mark_dynamic(example, 0)
+                self._ml_compiled(example)
+        torch.cuda.synchronize()
+        return self._ml_compiled
+
     async def process_rtmp_stream(self, stream_id, input_url):
         logger.info(f"Starting RTMP processing for stream {stream_id}")
 
+        self._ensure_pipeline()
+
         if GSTREAMER_AVAILABLE:
             pipeline = self.create_gstreamer_pipeline(input_url, stream_id)
         else:
@@ -142,7 +646,7 @@ class VideoProcessor:
 
             frame = self.gst_buffer_to_opencv(buffer, caps)
             if frame is not None:
-                asyncio.create_task(self.process_frame(stream_id, frame))
+                self._publish_frame(stream_id, frame)
 
         return Gst.FlowReturn.OK
 
@@ -152,15 +656,7 @@ class VideoProcessor:
             width = caps_structure.get_value('width')
             height = caps_structure.get_value('height')
 
-            success, map_info = buffer.map(Gst.MapFlags.READ)
-            if not success:
-                return None
-
-            numpy_array = np.frombuffer(map_info.data, dtype=np.uint8)
-            frame = numpy_array.reshape((height, width, 3))
-
-            buffer.unmap(map_info)
-            return frame
+            return GstMappedFrame.from_buffer(buffer, width, height)
         except Exception as e:
             logger.error(f"Error converting GStreamer buffer: {e}")
             return None
@@ -186,167 +682,534 @@ class VideoProcessor:
         finally:
             cap.release()
 
+    def _ensure_pipeline(self):
+        if not self._pipeline_tasks:
+            self.loop = asyncio.get_running_loop()
+            self._pipeline_tasks = [
+                self.loop.create_task(self._latest_frame_pump()),
+                self.loop.create_task(self._effects_stage()),
+                self.loop.create_task(self._encode_stage())
+            ]
+
+    def _publish_frame(self, stream_id, frame):
+        # Called from the GStreamer thread; a frame still waiting here is superseded
+        if self._latest.pop(stream_id, None) is not None:
+            slot = self._stream_slots.get(stream_id)
+            if slot is not None:
+                page, index = slot
+                page.dropped_frames[index] += 1
+
+        self._latest[stream_id] = (frame, time.monotonic())
+        self.loop.call_soon_threadsafe(self._frame_ready.set)
+
+    async def _latest_frame_pump(self):
+        while True:
+            await self._frame_ready.wait()
+            self._frame_ready.clear()
+
+            for stream_id in list(self._latest):
+                latest = self._latest.pop(stream_id, None)
+                if latest is not None:
+                    frame, captured_at = latest
+                    await self._effects_queue.put((stream_id, frame, captured_at))
+
     async def process_frame(self, stream_id, frame):
-        try:
-            processed_frame = await self.apply_effects(frame)
+        self._ensure_pipeline()
+        await self._effects_queue.put((stream_id, frame, time.monotonic()))
 
-            await self.output_frame(stream_id, processed_frame)
+    async def _effects_stage(self):
+        loop = asyncio.get_running_loop()
+        ml_config = self.config['processing_effects']['ml_enhancement']
 
-        except Exception as e:
-            logger.error(f"Error processing frame for stream {stream_id}: {e}")
+        while True:
+            stream_id, frame, captured_at = await self._effects_queue.get()
+            try:
+                processed_frame = await loop.run_in_executor(
+                    self._effects_executor, self.apply_effects, stream_id, frame)
+
+                # The encode stage awaits the ML result, so effects keep running meanwhile
+                if ml_config['enabled'] and 'enhancement' in self.models:
+                    processed_frame = self._submit_ml(processed_frame)
+            except Exception as e:
+                logger.error(f"Error processing frame for stream {stream_id}: {e}")
+                continue
+
+            await self._encode_queue.put((stream_id, processed_frame, captured_at))
+
+    async def _encode_stage(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            stream_id, processed_frame, captured_at = await self._encode_queue.get()
+            try:
+                if isinstance(processed_frame, asyncio.Future):
+                    processed_frame = await processed_frame
+
+                await loop.run_in_executor(
+                    self._encode_executor, self.output_frame, stream_id, processed_frame)
+                self._record_frame(stream_id, captured_at)
+            except Exception as e:
+                logger.error(f"Error processing frame for stream {stream_id}: {e}")
+
+    def _record_frame(self, stream_id, captured_at):
+        # Lock-free: only the encode stage writes these fields, and slots never move
+        slot = self._stream_slots.get(stream_id)
+        if slot is None:
+            return
+
+        page, index = slot
+        now = time.monotonic()
+        page.frame_counts[index] += 1
+        page.e2e_latency[index] += STATS_SMOOTHING * ((now - captured_at) - page.e2e_latency[index])
+        if not np.isnan(page.last_output_times[index]):
+            interval = now - page.last_output_times[index]
+            page.f2f_interval[index] += STATS_SMOOTHING * (interval - page.f2f_interval[index])
+        page.last_output_times[index] = now
+
+    def _scratch_buffers(self, stream_id, frame):
+        shape, work, outputs = self._scratch.get(stream_id, (None, None, None))
+        if shape != frame.shape:
+            gray_shape = frame.shape[:2]
+            work = (np.empty_like(frame), np.empty_like(frame),
+                    np.empty(gray_shape, np.uint8), np.empty(gray_shape, np.uint8))
+            # Only the last effect's output outlives apply_effects. One output per
+            # frame that can be in flight behind the effects stage: the encode
+            # queue, the frame being encoded and the one being produced.
+            output_shape = gray_shape if self._edge_terminal else frame.shape
+            outputs = itertools.cycle([
+                np.empty(output_shape, np.uint8) for _ in range(self._encode_queue.maxsize + 2)
+            ])
+            self._scratch[stream_id] = (frame.shape, work, outputs)
+        return work, next(outputs)
+
+    def apply_effects(self, stream_id, frame):
+        if self._gpu_effects:
+            return self.apply_effects_gpu(stream_id, frame)
 
-    async def apply_effects(self, frame):
         effects_config = self.config['processing_effects']
-        processed_frame = frame.copy()
+        blur_enabled = effects_config['blur']['enabled']
+        edge_enabled = effects_config['edge_detection']['enabled']
+        color_enabled = effects_config['color_filter']['enabled']
+
+        # Intermediate results ping-pong between two per-stream BGR work buffers
+        # instead of copying the input; the caller's frame is never written to.
+        # The other two hold the gray input and output of edge detection, and the
+        # last effect writes straight into the frame's output buffer.
+        work, output = self._scratch_buffers(stream_id, frame)
+        target = 0
+        processed_frame = frame
+
+        if blur_enabled:
+            dst = work[target] if edge_enabled or color_enabled else output
+            kernel_size = effects_config['blur']['kernel_size']
+            # Fastest path by kernel size on 1080p BGR, one thread: GaussianBlur's
+            # fixed-point kernels up to 5, the cached separable kernel up to 29,
+            # and stackBlur (constant cost, approximate Gaussian) from 31.
+            if kernel_size >= STACK_BLUR_MIN_KERNEL and hasattr(cv2, 'stackBlur'):
+                processed_frame = cv2.stackBlur(processed_frame, (kernel_size, kernel_size), dst=dst)
+            elif kernel_size <= 5:
+                processed_frame = cv2.GaussianBlur(processed_frame, (kernel_size, kernel_size), 0, dst=dst)
+            else:
+                processed_frame = cv2.sepFilter2D(processed_frame, -1, self._gauss_kernel,
+                                                  self._gauss_kernel, dst=dst)
+            target ^= 1
+
+        if edge_enabled:
+            if self._fast_luma:
+                gray = work[2]
+                fast_luma_bgr(processed_frame, gray)
+            else:
+                gray = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2GRAY, dst=work[2])
+            edges = cv2.Canny(gray,
+                            effects_config['edge_detection']['threshold1'],
+                            effects_config['edge_detection']['threshold2'],
+                            edges=output if self._edge_terminal else work[3])
+            if self._edge_terminal:
+                processed_frame = edges
+            else:
+                processed_frame = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR,
+                                               dst=work[target] if color_enabled else output)
+                target ^= 1
+
+        if color_enabled:
+            if self._fused_hue_shift:
+                hue_shift_bgr(processed_frame, output, effects_config['color_filter']['hue_shift'])
+                processed_frame = output
+            else:
+                hsv = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2HSV, dst=work[target])
+                cv2.LUT(hsv, self._hue_lut, dst=hsv)
+                processed_frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=output)
+
+        return processed_frame
+
+    def apply_effects_gpu(self, stream_id, frame):
+        effects_config = self.config['processing_effects']
+
+        gpu = self._gpu_scratch.get(stream_id)
+        if gpu is None:
+            gpu = [cv2.cuda_GpuMat() for _ in range(4)]
+            self._gpu_scratch[stream_id] = gpu
+
+        # One upload and one download per frame; every effect stays on the device
+        gpu[0].upload(frame)
+        current, spare = gpu[0], gpu[1]
 
         if effects_config['blur']['enabled']:
-            kernel_size = effects_config['blur']['kernel_size']
-            processed_frame = cv2.GaussianBlur(processed_frame, (kernel_size, kernel_size), 0)
+            self._gpu_blur.apply(current, spare)
+            current, spare = spare, current
 
         if effects_config['edge_detection']['enabled']:
-            gray = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2GRAY)
-            edges = cv2.Canny(gray,
-                            effects_config['edge_detection']['threshold1'],
-                            effects_config['edge_detection']['threshold2'])
-            processed_frame = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
+            cv2.cuda.cvtColor(current, cv2.COLOR_BGR2GRAY, gpu[2])
+            self._gpu_canny.detect(gpu[2], gpu[3])
+            if self._edge_terminal:
+                current = gpu[3]
+            else:
+                cv2.cuda.cvtColor(gpu[3], cv2.COLOR_GRAY2BGR, spare)
+                current, spare = spare, current
 
         if effects_config['color_filter']['enabled']:
-            hsv = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2HSV)
-            hsv[:,:,0] = (hsv[:,:,0] + effects_config['color_filter']['hue_shift']) % 180
-            processed_frame = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+            cv2.cuda.cvtColor(current, cv2.COLOR_BGR2HSV, spare)
+            self._gpu_hue_lut.transform(spare, current)
+            cv2.cuda.cvtColor(current, cv2.COLOR_HSV2BGR, spare)
+            current, spare = spare, current
 
-        if effects_config['ml_enhancement']['enabled'] and 'enhancement' in self.models:
-            processed_frame = await self.apply_ml_enhancement(processed_frame)
+        # The ping-pong can leave the result in gpu[0], so its identity says nothing
+        # about whether an effect ran; this path only runs with at least one enabled
+        _, output = self._scratch_buffers(stream_id, frame)
+        return current.download(output)
 
-        return processed_frame
+    def _submit_ml(self, frame):
+        loop = asyncio.get_running_loop()
+        if self._ml_worker_task is None or self._ml_worker_task.done():
+            self._ml_worker_task = loop.create_task(self._ml_batch_worker())
 
-    async def apply_ml_enhancement(self, frame):
-        try:
-            with torch.no_grad():
-                frame_tensor = torch.from_numpy(frame).permute(2, 0, 1).float() / 255.0
-                frame_tensor = frame_tensor.unsqueeze(0).to(self.device)
+        future = loop.create_future()
+        self.ml_queue.put_nowait((frame, future))
+        return future
+
+    async def _ml_batch_worker(self):
+        loop = asyncio.get_running_loop()
+        inflight = None
 
-                enhanced = self.models['enhancement'](frame_tensor)
-                enhanced = enhanced.squeeze(0).permute(1, 2, 0).cpu().numpy()
-                enhanced = np.clip(enhanced * 255, 0, 255).astype(np.uint8)
+        while True:
+            items = [await self.ml_queue.get()]
+            deadline = loop.time() + self.ml_batch_timeout
 
-                return enhanced
+            while len(items) < self.ml_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.ml_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Streams may differ in resolution, so run one forward pass per shape
+            batches = {}
+            for frame, future in items:
+                batches.setdefault(frame.shape, []).append((frame, future))
+
+            for batch in batches.values():
+                frames = [frame for frame, _ in batch]
+                try:
+                    launched = await loop.run_in_executor(self._ml_executor, self._launch_ml_batch, frames)
+                except Exception as e:
+                    logger.error(f"ML enhancement failed: {e}")
+                    self._resolve_ml_batch(batch, frames)
+                    continue
+
+                # Collect the previous batch only after this one is queued on the GPU
+                if inflight is not None:
+                    await self._finish_ml_batch(*inflight)
+                inflight = (batch, launched)
+
+            if inflight is not None and self.ml_queue.empty():
+                await self._finish_ml_batch(*inflight)
+                inflight = None
+
+    async def _finish_ml_batch(self, batch, launched):
+        loop = asyncio.get_running_loop()
+        try:
+            enhanced = await loop.run_in_executor(self._ml_executor, self._collect_ml_batch, *launched)
         except Exception as e:
             logger.error(f"ML enhancement failed: {e}")
-            return frame
-
-    async def output_frame(self, stream_id, frame):
+            enhanced = [frame for frame, _ in batch]
+
+        self._resolve_ml_batch(batch, enhanced)
+
+    def _resolve_ml_batch(self, batch, results):
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def _ml_buffers(self, shape):
+        buffers = self._ml_stage.get(shape)
+        if buffers is None:
+            height, width = shape[:2]
+            batch_shape = (self.ml_batch_size, 3, height, width)
+            if self.device.type == 'cuda':
+                # Two pinned host / device uint8 pairs, so one batch can upload while the other runs
+                buffers = itertools.cycle([
+                    (torch.empty(batch_shape, dtype=torch.uint8, pin_memory=True),
+                     torch.empty(batch_shape, dtype=torch.uint8, device=self.device))
+                    for _ in range(2)
+                ])
+            else:
+                # On the CPU the model reads the staging tensor directly
+                host = torch.empty(batch_shape, dtype=torch.uint8)
+                buffers = itertools.cycle([(host, host)])
+            self._ml_stage[shape] = buffers
+        return next(buffers)
+
+    def _launch_ml_batch(self, frames):
+        host, device = self._ml_buffers(frames[0].shape)
+        count = len(frames)
+        use_cuda = self.device.type == 'cuda'
+
+        with torch.inference_mode():
+            # Accumulate CHW views and stack once; growing a tensor with torch.cat is O(n^2)
+            pending = [torch.from_numpy(frame).permute(2, 0, 1) for frame in frames]
+            staged = torch.stack(pending, out=host[:count])
+
+            if use_cuda:
+                with torch.cuda.stream(self._h2d_stream):
+                    device[:count].copy_(staged, non_blocking=True)
+                torch.cuda.current_stream().wait_stream(self._h2d_stream)
+                staged = device[:count]
+
+            if self._ml_quantized:
+                batch = torch._make_per_tensor_quantized_tensor(staged, 1 / 255.0, 0)
+                enhanced = self.models['enhancement'](batch).int_repr()
+            else:
+                with torch.cuda.amp.autocast(enabled=self.ml_half, dtype=torch.float16):
+                    batch = staged.float().mul_(1 / 255.0)
+                    batch = batch.to(memory_format=torch.channels_last)
+
+                    enhanced = self._enhancer_for(batch)(batch)
+                    enhanced = enhanced.clamp_(0, 1).mul_(255).to(torch.uint8)
+
+            # Scale, cast and repack to HWC on the device so the D2H copy is one dense uint8 transfer
+            enhanced = enhanced.permute(0, 2, 3, 1).contiguous()
+            output = torch.empty(enhanced.shape, dtype=torch.uint8, pin_memory=use_cuda)
+            output.copy_(enhanced, non_blocking=use_cuda)
+
+        done = None
+        if use_cuda:
+            done = torch.cuda.Event()
+            done.record()
+
+        return output, done
+
+    def _collect_ml_batch(self, output, done):
+        if done is not None:
+            done.synchronize()
+        return list(output.numpy())
+
+    def output_frame(self, stream_id, frame):
         output_configs = self.active_streams.get(stream_id, {}).get('outputs', [])
+        segmented = False
 
         for output_config in output_configs:
             if output_config['type'] == 'webrtc':
-                await self.output_webrtc(stream_id, frame, output_config)
-            elif output_config['type'] == 'hls':
-                await self.output_hls(stream_id, frame, output_config)
-            elif output_config['type'] == 'dash':
-                await self.output_dash(stream_id, frame, output_config)
+                self.output_webrtc(stream_id, frame, output_config)
+            elif output_config['type'] in ('hls', 'dash'):
+                segmented = True
 
-    async def output_webrtc(self, stream_id, frame, config):
+        # HLS and DASH share one encoder, so the frame is written once
+        if segmented:
+            self.output_segmented(stream_id, frame)
+
+    def output_webrtc(self, stream_id, frame, config):
         try:
-            encoded_frame = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])[1]
+            # OpenCV's wheels already encode through libjpeg-turbo; pass the
+            # encoded buffer on as a view rather than copying it to bytes.
+            encoded_frame = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].data
 
-            self.send_to_webrtc_client(stream_id, encoded_frame.tobytes())
+            self.send_to_webrtc_client(stream_id, encoded_frame)
         except Exception as e:
             logger.error(f"WebRTC output error: {e}")
 
-    async def output_hls(self, stream_id, frame, config):
-        output_path = f"output/{stream_id}/hls"
-        os.makedirs(output_path, exist_ok=True)
-
-        ffmpeg_cmd = [
-            'ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
-            '-s', f"{frame.shape[1]}x{frame.shape[0]}", '-r', '30',
-            '-i', 'pipe:0',
-            '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
-            '-hls_time', str(self.config['streaming']['hls_segment_duration']),
-            '-hls_playlist_type', 'event',
-            f"{output_path}/playlist.m3u8"
-        ]
-
+    def output_segmented(self, stream_id, frame):
         try:
-            if not hasattr(self, f'hls_process_{stream_id}'):
-                process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
-                setattr(self, f'hls_process_{stream_id}', process)
-
-            process = getattr(self, f'hls_process_{stream_id}')
-            process.stdin.write(frame.tobytes())
-            process.stdin.flush()
+            process = self._encoders.get(stream_id)
+            # The encoder reads raw frames of a fixed size, which add_stream may
+            # have been told wrongly or the source may since have changed
+            if process is not None and frame.shape != self._encoder_shapes.get(stream_id):
+                logger.warning(f"Stream {stream_id} frame shape {frame.shape} does not match encoder "
+                               f"shape {self._encoder_shapes.get(stream_id)}; restarting encoder")
+                self._stop_encoder(stream_id)
+                process = None
+            if process is None:
+                process = self._ensure_encoder(stream_id, frame.shape)
+            self.write_frame(process, frame)
 
         except Exception as e:
-            logger.error(f"HLS output error: {e}")
-
-    async def output_dash(self, stream_id, frame, config):
-        output_path = f"output/{stream_id}/dash"
-        os.makedirs(output_path, exist_ok=True)
+            logger.error(f"HLS/DASH output error: {e}")
+
+    def write_frame(self, process, frame):
+        # Write straight from the frame's memory instead of a tobytes() copy
+        view = memoryview(np.ascontiguousarray(frame)).cast('B')
+        fd = process.stdin.fileno()
+
+        while view:
+            written = os.writev(fd, [view])
+            view = view[written:]
+
+    def nvenc_available(self):
+        if self._nvenc_available is None:
+            self._nvenc_available = False
+
+            if GPU_AVAILABLE and self.config.get('gpu_enabled', True):
+                probe_cmd = [
+                    'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', 'color=size=256x256:duration=0.1',
+                    '-c:v', 'h264_nvenc', '-f', 'null', '-'
+                ]
+                try:
+                    result = subprocess.run(probe_cmd, stdout=subprocess.DEVNULL,
+                                            stderr=subprocess.DEVNULL, timeout=10)
+                    self._nvenc_available = result.returncode == 0
+                except Exception as e:
+                    logger.warning(f"NVENC probe failed: {e}")
+
+            logger.info(f"Video encoder: {'h264_nvenc' if self._nvenc_available else 'libx264'}")
+
+        return self._nvenc_available
+
+    def encoder_command(self, stream_id, shape):
+        ffmpeg_cmd = self._encoder_cmds.get(stream_id)
+        if ffmpeg_cmd is not None:
+            return ffmpeg_cmd
+
+        output_types = {out['type'] for out in self.active_streams.get(stream_id, {}).get('outputs', [])}
+        tee_outputs = []
+
+        if 'hls' in output_types:
+            output_path = f"output/{stream_id}/hls"
+            os.makedirs(output_path, exist_ok=True)
+            tee_outputs.append(
+                f"[f=hls:hls_time={self.config['streaming']['hls_segment_duration']}"
+                f":hls_playlist_type=event]{output_path}/playlist.m3u8")
+
+        if 'dash' in output_types:
+            output_path = f"output/{stream_id}/dash"
+            os.makedirs(output_path, exist_ok=True)
+            tee_outputs.append(
+                f"[f=dash:seg_duration={self.config['streaming']['dash_segment_duration']}]"
+                f"{output_path}/manifest.mpd")
+
+        if self.nvenc_available():
+            codec_args = ['-c:v', 'h264_nvenc', '-preset', 'p4', '-tune', 'll']
+        else:
+            codec_args = ['-c:v', 'libx264', '-preset', 'fast', '-crf', '23']
 
+        pix_fmt = 'gray' if len(shape) == 2 else 'bgr24'
         ffmpeg_cmd = [
-            'ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', 'bgr24',
-            '-s', f"{frame.shape[1]}x{frame.shape[0]}", '-r', '30',
+            'ffmpeg', '-y', '-f', 'rawvideo', '-pix_fmt', pix_fmt,
+            '-s', f"{shape[1]}x{shape[0]}", '-r', '30',
             '-i', 'pipe:0',
-            '-c:v', 'libx264', '-preset', 'fast', '-crf', '23',
-            '-seg_duration', str(self.config['streaming']['dash_segment_duration']),
-            '-f', 'dash',
-            f"{output_path}/manifest.mpd"
+            # Gray frames keep the pipe small, but 4:0:0 H.264 is not widely decodable
+            '-pix_fmt', 'yuv420p',
+            *codec_args,
+            '-map', '0:v', '-f', 'tee',
+            '|'.join(tee_outputs)
         ]
 
-        try:
-            if not hasattr(self, f'dash_process_{stream_id}'):
-                process = subprocess.Popen(ffmpeg_cmd, stdin=subprocess.PIPE)
-                setattr(self, f'dash_process_{stream_id}', process)
+        self._encoder_cmds[stream_id] = ffmpeg_cmd
+        return ffmpeg_cmd
 
-            process = getattr(self, f'dash_process_{stream_id}')
-            process.stdin.write(frame.tobytes())
-            process.stdin.flush()
+    def _ensure_encoder(self, stream_id, shape):
+        process = self._encoders.get(stream_id)
+        if process is not None:
+            return process
 
-        except Exception as e:
-            logger.error(f"DASH output error: {e}")
+        process = subprocess.Popen(self.encoder_command(stream_id, shape), stdin=subprocess.PIPE, bufsize=0)
+        try:
+            fcntl.fcntl(process.stdin.fileno(), PIPE_SIZE_FLAG, PIPE_SIZE)
+        except OSError as e:
+            logger.warning(f"Could not enlarge encoder pipe for stream {stream_id}: {e}")
+
+        self._encoders[stream_id] = process
+        self._encoder_shapes[stream_id] = tuple(shape)
+        return process
+
+    def _stop_encoder(self, stream_id):
+        self._encoder_cmds.pop(stream_id, None)
+        self._encoder_shapes.pop(stream_id, None)
+        process = self._encoders.pop(stream_id, None)
+        if process is not None:
+            try:
+                process.stdin.close()
+                process.terminate()
+                process.wait(timeout=5)
+            except:
+                process.kill()
 
     def send_to_webrtc_client(self, stream_id, frame_data):
         pass
 
-    def add_stream(self, stream_id, input_config, output_configs):
+    def add_stream(self, stream_id, input_config, output_configs, width=None, height=None):
         with self.lock:
             self.active_streams[stream_id] = {
                 'input': input_config,
-                'outputs': output_configs,
-                'start_time': time.time(),
-                'frame_count': 0
+                'outputs': output_configs
             }
 
+            slot = self._stream_slots.get(stream_id)
+            if slot is None:
+                page_number, index = divmod(self._stats_slots_used, STREAM_STATS_PAGE_SIZE)
+                if page_number == len(self._stats_pages):
+                    self._stats_pages.append(StreamStatsPage(STREAM_STATS_PAGE_SIZE))
+                self._stats_slots_used += 1
+                slot = (self._stats_pages[page_number], index)
+                self._stream_slots[stream_id] = slot
+
+            page, index = slot
+            page.reset(index)
+
+        # With the frame size known up front the encoder starts now instead of on the first frame
+        if width and height and any(out['type'] in ('hls', 'dash') for out in output_configs):
+            shape = (height, width) if self._edge_terminal else (height, width, 3)
+            try:
+                self._ensure_encoder(stream_id, shape)
+            except Exception as e:
+                logger.error(f"Failed to start encoder for stream {stream_id}: {e}")
+
+        # Likewise build the accelerated model before the stream's first batch.
+        # INT8 engines wait for that batch, since it is their calibration data.
+        if width and height and 'enhancement' in self.models and not (
+                self._trt_onnx_path is not None and self.ml_precision == 'int8'):
+            self.prepare_enhancer(height, width)
+
     def remove_stream(self, stream_id):
         with self.lock:
             if stream_id in self.active_streams:
                 del self.active_streams[stream_id]
-
-                for process_attr in [f'hls_process_{stream_id}', f'dash_process_{stream_id}']:
-                    if hasattr(self, process_attr):
-                        process = getattr(self, process_attr)
-                        try:
-                            process.stdin.close()
-                            process.terminate()
-                            process.wait(timeout=5)
-                        except:
-                            process.kill()
-                        delattr(self, process_attr)
+                self._scratch.pop(stream_id, None)
+                self._gpu_scratch.pop(stream_id, None)
+                self._latest.pop(stream_id, None)
+                self._stream_slots.pop(stream_id, None)
+                self._stop_encoder(stream_id)
 
     def get_stream_stats(self, stream_id):
-        if stream_id not in self.active_streams:
+        # Both lookups tolerate a concurrent remove_stream
+        slot = self._stream_slots.get(stream_id)
+        stream = self.active_streams.get(stream_id)
+        if slot is None or stream is None:
             return None
 
-        stream = self.active_streams[stream_id]
-        current_time = time.time()
-        duration = current_time - stream['start_time']
+        page, index = slot
+        duration = time.time() - page.start_times[index]
+        frame_count = int(page.frame_counts[index])
 
         return {
             'stream_id': stream_id,
-            'duration': duration,
-            'frame_count': stream['frame_count'],
-            'fps': stream['frame_count'] / duration if duration > 0 else 0,
+            'duration': float(duration),
+            'frame_count': frame_count,
+            'fps': float(frame_count / duration) if duration > 0 else 0,
+            'dropped_frames': int(page.dropped_frames[index]),
+            'e2e_latency_ms': float(page.e2e_latency[index] * 1000),
+            'f2f_interval_ms': float(page.f2f_interval[index] * 1000),
             'input_type': stream['input']['type'],
             'output_types': [out['type'] for out in stream['outputs']]
         }
@@ -357,7 +1220,9 @@ class VideoProcessor:
         for stream_id in list(self.active_streams.keys()):
             self.remove_stream(stream_id)
 
-        self.executor.shutdown(wait=True)
+        for executor in (self._effects_executor, self._ml_executor, self._encode_executor):
+            executor.shutdown(wait=True)
+        self._ml_build_executor.shutdown(wait=False, cancel_futures=True)
 
 if __name__ == "__main__":
     processor = VideoProcessor()